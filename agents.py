@@ -1,16 +1,26 @@
-from langchain.agents import Tool, AgentExecutor, create_openai_functions_agent
+from langchain.agents import Tool, AgentExecutor, create_openai_tools_agent
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
 from models import PersonagemDnD, Atributos
 from typing import Dict, Any
+from collections import OrderedDict
+from concurrent.futures import Future
 import json
+import threading
 from knowledge_base import DnDKnowledgeBase
+from config import CHAT_MEMORY_MAX_TOKENS, TOOL_CACHE_SIZE
 
 
 class CharacterCreationAgent:
    def __init__(self, llm: ChatOpenAI):
        self.llm = llm
        self.knowledge_base = DnDKnowledgeBase(llm)
+       # Cache das ferramentas, compartilhado por todas as sessões
+       self._tool_cache: OrderedDict[tuple[str, str], str] = OrderedDict()
+       self._tool_cache_lock = threading.Lock()
+       # Consultas em andamento: quem pedir a mesma chave espera o resultado em vez de repetir a consulta
+       self._tool_em_andamento: Dict[tuple[str, str], Future] = {}
        self.tools = self._setup_tools()
        self.agent = self._setup_agent()
   
@@ -42,34 +52,120 @@ class CharacterCreationAgent:
        prompt = ChatPromptTemplate.from_messages([
            ("system", """Você é um assistente especializado em criar personagens de D&D.
            Guie o usuário pelo processo de criação, oferecendo sugestões e explicações.
-           Use as ferramentas disponíveis para obter informações precisas do livro."""),
+           Use as ferramentas disponíveis para obter informações precisas do livro.
+           Quando precisar de informações sobre mais de um tópico, chame as ferramentas juntas."""),
+           MessagesPlaceholder(variable_name="chat_history"),
            ("human", "{input}"),
            MessagesPlaceholder(variable_name="agent_scratchpad"),
        ])
       
-       agent = create_openai_functions_agent(self.llm, self.tools, prompt)
+       # O agente de tools permite várias chamadas por turno, executadas em paralelo no ainvoke
+       agent = create_openai_tools_agent(self.llm, self.tools, prompt)
        return AgentExecutor(agent=agent, tools=self.tools)
 
 
+   def nova_memoria(self) -> Dict[str, Any]:
+       """Cria a memória de uma sessão: resumo das mensagens antigas e as mensagens recentes"""
+       return {"resumo": "", "mensagens": []}
+
+
+   async def conversar(self, mensagem: str, memoria: Dict[str, Any]) -> tuple[str, Dict[str, Any]]:
+       """Responde a mensagem e devolve a memória atualizada, sem alterar a recebida"""
+       historico = list(memoria["mensagens"])
+       if memoria["resumo"]:
+           historico.insert(0, SystemMessage(content=f"Resumo da conversa até aqui: {memoria['resumo']}"))
+      
+       resultado = await self.agent.ainvoke({
+           "input": mensagem,
+           "chat_history": historico
+       })
+      
+       mensagens = memoria["mensagens"] + [HumanMessage(content=mensagem), AIMessage(content=resultado["output"])]
+       memoria = await self._resumir_excedente({"resumo": memoria["resumo"], "mensagens": mensagens})
+       return resultado["output"], memoria
+
+
+   async def _resumir_excedente(self, memoria: Dict[str, Any]) -> Dict[str, Any]:
+       # Mantém as mensagens recentes dentro do limite; as mais antigas são incorporadas ao resumo
+       mensagens = memoria["mensagens"]
+       antigas: list[BaseMessage] = []
+       while len(mensagens) > 2 and self.llm.get_num_tokens_from_messages(mensagens) > CHAT_MEMORY_MAX_TOKENS:
+           antigas.extend(mensagens[:2])
+           mensagens = mensagens[2:]
+      
+       if not antigas:
+           return memoria
+      
+       trecho = "\n".join(
+           f"{'Usuário' if isinstance(m, HumanMessage) else 'Assistente'}: {m.content}" for m in antigas
+       )
+       prompt = f"""
+       Atualize o resumo de uma conversa sobre criação de personagem de D&D.
+      
+       Resumo atual:
+       {memoria["resumo"] or "(vazio)"}
+      
+       Novas mensagens:
+       {trecho}
+      
+       Mantenha as escolhas já feitas (raça, classe, antecedente, alinhamento, atributos)
+       e as preferências do usuário. Responda apenas com o novo resumo.
+       """
+       response = await self.llm.ainvoke(prompt)
+       return {"resumo": response.content, "mensagens": mensagens}
+
+
+   def _consultar(self, tipo: str, nome: str, query: str) -> str:
+       chave = (tipo, nome.strip().lower())
+       with self._tool_cache_lock:
+           if chave in self._tool_cache:
+               self._tool_cache.move_to_end(chave)
+               return self._tool_cache[chave]
+           futuro = self._tool_em_andamento.get(chave)
+           if futuro is None:
+               futuro = Future()
+               self._tool_em_andamento[chave] = futuro
+               responsavel = True
+           else:
+               responsavel = False
+      
+       if not responsavel:
+           return futuro.result()
+      
+       try:
+           resposta = self.knowledge_base.query(query)["resposta"]
+       except BaseException as e:
+           # BaseException também: um KeyboardInterrupt/CancelledError não pode deixar quem espera travado
+           with self._tool_cache_lock:
+               del self._tool_em_andamento[chave]
+           futuro.set_exception(e)
+           raise
+      
+       with self._tool_cache_lock:
+           self._tool_cache[chave] = resposta
+           self._tool_cache.move_to_end(chave)
+           while len(self._tool_cache) > TOOL_CACHE_SIZE:
+               self._tool_cache.popitem(last=False)
+           del self._tool_em_andamento[chave]
+       futuro.set_result(resposta)
+       return resposta
+
+
    def get_race_info(self, race: str) -> str:
        query = f"Descreva detalhadamente a raça {race} em D&D 5e"
-       result = self.knowledge_base.query(query)
-       return result["resposta"]
+       return self._consultar("race", race, query)
   
    def get_class_info(self, class_name: str) -> str:
        query = f"Descreva detalhadamente a classe {class_name} em D&D 5e"
-       result = self.knowledge_base.query(query)
-       return result["resposta"]
+       return self._consultar("class", class_name, query)
   
    def get_background_info(self, background: str) -> str:
        query = f"Descreva detalhadamente o antecedente {background} em D&D 5e"
-       result = self.knowledge_base.query(query)
-       return result["resposta"]
+       return self._consultar("background", background, query)
   
    def get_alinhamento_info(self, alignment: str) -> str:
        query = f"Descreva detalhadamente o alinhamento {alignment} em D&D 5e"
-       result = self.knowledge_base.query(query)
-       return result["resposta"]
+       return self._consultar("alignment", alignment, query)
   
    def create_character(self, data: Dict[str, Any]) -> PersonagemDnD:
        # Cria um personagem com os dados fornecidos
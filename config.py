@@ -19,6 +19,28 @@ CAPITULOS: Dict[str, Dict[str, any]] = {
     "spells": {"start": 209, "end": 289, "name": "Magias"}
 }
 
+# Fontes da base de conhecimento. Cada fonte tem seu próprio mapa de capítulos e
+# sua própria partição de índice, reconstruída apenas quando a fonte muda.
+# Os ids de capítulo seguem os de CAPITULOS para que KEYWORD_MAPPING funcione em todas.
+INDICES_PATH = "indices"
+FONTES: Dict[str, Dict[str, any]] = {
+    "player-book": {
+        "name": "Livro do Jogador",
+        "pdf_path": PDF_PATH,
+        "index_path": KNOWLEDGE_BASE_PATH,
+        "capitulos": CAPITULOS
+    },
+    # Exemplo de suplemento:
+    # "xanathar": {
+    #     "name": "Guia de Xanathar para Todas as Coisas",
+    #     "pdf_path": "xanathar.pdf",
+    #     "capitulos": {
+    #         "classes": {"start": 8, "end": 71, "name": "Opções de Personagem"},
+    #         "spells": {"start": 133, "end": 175, "name": "Magias"}
+    #     }
+    # }
+}
+
 # Mapeamento de palavras-chave para capítulos
 KEYWORD_MAPPING = {
     "races": ['raça', 'elfo', 'anão', 'humano', 'halfling', 'draconato', 'gnomo', 'tiefling'],
@@ -29,4 +51,15 @@ KEYWORD_MAPPING = {
     "spells": ['magia', 'feitiço', 'conjuração', 'spell'],
     "abilities": ['habilidade', 'perícia', 'atributo'],
     "combat": ['combate', 'luta', 'ataque', 'dano']
-} 
\ No newline at end of file
+} 
+
+# Persistência dos personagens criados
+CHARACTERS_DB_PATH = "personagens.db"
+STORAGE_BATCH_SIZE = 100  # Máximo de personagens gravados por transação
+STORAGE_FLUSH_INTERVAL = 0.5  # Prazo máximo, em segundos, para gravar um lote desde o primeiro personagem
+EXPORTS_MAX_AGE = 3600  # Segundos até uma exportação ser apagada do disco
+
+# Modo de criação conversacional
+CHAT_MEMORY_MAX_TOKENS = 1000  # Acima disso as mensagens mais antigas viram um resumo
+TOOL_CACHE_SIZE = 256  # Respostas das ferramentas do agente mantidas em cache
+CHAT_CONCURRENCY_LIMIT = None  # Conversas atendidas ao mesmo tempo (None = sem limite)
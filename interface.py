@@ -3,8 +3,14 @@ from langchain_openai import ChatOpenAI
 from agents import CharacterCreationAgent, StorytellingAgent, IllustrationAgent
 from models import Atributos, PersonagemDnD, Raca, Classe
 from utils import validar_pontos_atributos
-import json
+from storage import PersonagemStore
+from config import FONTES, EXPORTS_MAX_AGE, CHAT_CONCURRENCY_LIMIT
+import atexit
+import orjson
 import os
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 from openai import OpenAI  # Para geração de imagens
 
@@ -25,14 +31,30 @@ character_agent = CharacterCreationAgent(llm)
 story_agent = StorytellingAgent(llm)
 illustration_agent = IllustrationAgent(llm)
 client = OpenAI()  # Cliente para DALL-E
+store = PersonagemStore()
+atexit.register(store.fechar)  # Grava os personagens ainda na fila ao encerrar
 
 
-def get_info(conceito: str) -> str:
-   """Obtém informações detalhadas sobre um conceito"""
+ANTECEDENTES = ["Acólito", "Artesão", "Artista", "Charlatão", "Criminoso", "Eremita",
+               "Forasteiro", "Herói do Povo", "Nobre", "Marinheiro", "órfão", "Sábio", "Soldado"]
+
+ALINHAMENTOS = ["Leal e Bom", "Neutro e Bom", "Caótico e Bom",
+               "Leal e Neutro", "Neutro", "Caótico e Neutro",
+               "Leal e Mau", "Neutro e Mau", "Caótico e Mau"]
+
+COLUNAS_BIBLIOTECA = ["ID", "Nome", "Raça", "Classe", "Antecedente", "Alinhamento", "Criado em"]
+POR_PAGINA = 20
+
+EXPORTS_DIR = os.path.join(tempfile.gettempdir(), "personagens_exports")
+os.makedirs(EXPORTS_DIR, exist_ok=True)
+
+
+def get_info(conceito: str, fontes: list[str] = None) -> str:
+   """Obtém informações detalhadas sobre um conceito, opcionalmente restrito a algumas fontes"""
    try:
        if not conceito:
            return "Por favor, selecione uma opção primeiro."
-       return character_agent.knowledge_base.query(f"Descreva detalhadamente {conceito} em D&D 5e")["resposta"]
+       return character_agent.knowledge_base.query(f"Descreva detalhadamente {conceito} em D&D 5e", fontes=fontes)["resposta"]
    except Exception as e:
        return f"Erro ao buscar informações: {str(e)}"
 
@@ -97,8 +119,11 @@ def criar_personagem(nome, sexo, raca, classe, antecedente, alinhamento,
        # Gera o prompt para ilustração
        prompt_ilustracao = illustration_agent.generate_illustration_prompt(personagem)
       
+       # Salva na biblioteca (gravação em segundo plano)
+       store.salvar(personagem)
+      
        # Formata a saída em JSON
-       json_output = json.dumps(personagem.model_dump(), indent=2, ensure_ascii=False)
+       json_output = orjson.dumps(personagem.model_dump(mode="json"), option=orjson.OPT_INDENT_2).decode()
       
        # Formata a visualização para o usuário
        markdown_output = f"""
@@ -143,6 +168,109 @@ def criar_personagem(nome, sexo, raca, classe, antecedente, alinhamento,
        return f"❌ Erro ao criar personagem: {str(e)}", None, None
 
 
+def buscar_personagens(nome, raca, classe, antecedente, alinhamento, pagina) -> tuple[list, str]:
+   """Busca personagens salvos, paginados, com os filtros informados"""
+   filtros = {
+       "nome": nome,
+       "raca": raca,
+       "classe": classe,
+       "antecedente": antecedente,
+       "alinhamento": alinhamento
+   }
+   pagina = max(int(pagina or 1), 1)
+   total = store.contar(**filtros)
+   total_paginas = max((total + POR_PAGINA - 1) // POR_PAGINA, 1)
+   personagens = store.buscar(pagina=pagina, por_pagina=POR_PAGINA, **filtros)
+   linhas = [
+       [p["id"], p["nome"], p["raca"], p["classe"], p["antecedente"], p["alinhamento"], p["criado_em"]]
+       for p in personagens
+   ]
+   return linhas, f"**{total}** personagens encontrados — página {pagina} de {total_paginas}"
+
+
+def carregar_personagem(personagem_id) -> str:
+   """Retorna o JSON de um personagem salvo"""
+   if not personagem_id:
+       return None
+   personagem = store.carregar(int(personagem_id))
+   if personagem is None:
+       gr.Warning(f"Personagem {int(personagem_id)} não encontrado.")
+       return None
+   return orjson.dumps(personagem.model_dump(mode="json"), option=orjson.OPT_INDENT_2).decode()
+
+
+def limpar_exportacoes():
+   """Remove exportações antigas, que já foram entregues ao navegador"""
+   limite = time.time() - EXPORTS_MAX_AGE
+   for nome_arquivo in os.listdir(EXPORTS_DIR):
+       caminho = os.path.join(EXPORTS_DIR, nome_arquivo)
+       try:
+           if os.path.getmtime(caminho) < limite:
+               os.remove(caminho)
+       except OSError:
+           pass
+
+
+def exportar_personagens(formato, nome, raca, classe, antecedente, alinhamento) -> str:
+   """Exporta os personagens filtrados para um arquivo JSONL ou CSV"""
+   filtros = {
+       "nome": nome,
+       "raca": raca,
+       "classe": classe,
+       "antecedente": antecedente,
+       "alinhamento": alinhamento
+   }
+   extensao = "csv" if formato == "CSV" else "jsonl"
+   limpar_exportacoes()
+   # Garante que os personagens ainda na fila de gravação entrem na exportação
+   store.flush()
+   with tempfile.NamedTemporaryFile(prefix="personagens_", suffix=f".{extensao}", dir=EXPORTS_DIR, delete=False) as arquivo:
+       caminho = arquivo.name
+   if extensao == "csv":
+       store.exportar_csv(caminho, **filtros)
+   else:
+       store.exportar_jsonl(caminho, **filtros)
+   return caminho
+
+
+# Sessões com um turno em andamento: barra um segundo envio (Enter + Enviar) que chegue
+# antes de a entrada ser bloqueada, para que dois turnos não partam da mesma memória
+sessoes_em_turno: set[str] = set()
+sessoes_em_turno_lock = threading.Lock()
+
+
+def bloquear_entrada():
+   """Passo rápido: bloqueia a entrada enquanto o assistente responde"""
+   return gr.update(interactive=False), gr.update(interactive=False)
+
+
+async def conversar(mensagem, historico, memoria, request: gr.Request):
+   """Envia uma mensagem ao assistente de criação, mantendo a memória da sessão"""
+   liberar = (gr.update(value="", interactive=True), gr.update(interactive=True))
+   if not mensagem:
+       return (gr.update(interactive=True), gr.update(interactive=True), gr.skip(), gr.skip())
+   with sessoes_em_turno_lock:
+       if request.session_hash in sessoes_em_turno:
+           # Segundo envio do mesmo turno: não altera nada, quem está em andamento libera a entrada
+           return gr.skip(), gr.skip(), gr.skip(), gr.skip()
+       sessoes_em_turno.add(request.session_hash)
+   try:
+       if memoria is None:
+           memoria = character_agent.nova_memoria()
+       try:
+           resposta, memoria = await character_agent.conversar(mensagem, memoria)
+       except Exception as e:
+           resposta = f"❌ Erro ao conversar com o assistente: {str(e)}"
+   finally:
+       with sessoes_em_turno_lock:
+           sessoes_em_turno.discard(request.session_hash)
+   historico = historico + [
+       {"role": "user", "content": mensagem},
+       {"role": "assistant", "content": resposta}
+   ]
+   return (*liberar, historico, memoria)
+
+
 def atualizar_pontos(forca, destreza, constituicao, inteligencia, sabedoria, carisma):
    """Calcula e formata os pontos gastos/restantes"""
    atributos = Atributos(
@@ -159,7 +287,8 @@ def atualizar_pontos(forca, destreza, constituicao, inteligencia, sabedoria, car
 
 
 def interface():
-   with gr.Blocks(title="Criador de Personagem D&D 🎲") as app:
+   # delete_cache também apaga a cópia que o Gradio faz dos arquivos exportados
+   with gr.Blocks(title="Criador de Personagem D&D 🎲", delete_cache=(EXPORTS_MAX_AGE, EXPORTS_MAX_AGE)) as app:
        tabs = gr.Tabs()  # Criando o container de tabs
       
        with tabs:  # Usando with para criar as tabs
@@ -181,8 +310,7 @@ def interface():
                       
                        with gr.Row():
                            antecedente = gr.Dropdown(
-                               choices=["Acólito", "Artesão", "Artista", "Charlatão", "Criminoso", "Eremita",
-                                       "Forasteiro", "Herói do Povo", "Nobre", "Marinheiro", "órfão", "Sábio", "Soldado"],
+                               choices=ANTECEDENTES,
                                label="Antecedente",
                                scale=9
                            )
@@ -190,9 +318,7 @@ def interface():
                       
                        with gr.Row():
                            alinhamento = gr.Dropdown(
-                               choices=["Leal e Bom", "Neutro e Bom", "Caótico e Bom",
-                                       "Leal e Neutro", "Neutro", "Caótico e Neutro",
-                                       "Leal e Mau", "Neutro e Mau", "Caótico e Mau"],
+                               choices=ALINHAMENTOS,
                                label="Alinhamento",
                                scale=9
                            )
@@ -214,6 +340,11 @@ def interface():
               
                # Área de informações movida para baixo
                gr.Markdown("### 📚 Informações")
+               fontes = gr.Dropdown(
+                   choices=[(info["name"], fonte_id) for fonte_id, info in FONTES.items()],
+                   multiselect=True,
+                   label="Fontes (vazio = todas)"
+               )
                info_output = gr.Markdown(
                    "Selecione uma opção e clique no botão ❓ para ver informações",
                    elem_id="info-box"
@@ -247,6 +378,43 @@ def interface():
                    prompt_ilustracao = gr.Textbox(label="Prompt para Ilustração")
 
 
+           with gr.TabItem("Conversa"):
+               gr.Markdown("### 💬 Criação guiada\nConverse com o assistente para montar seu personagem passo a passo.")
+               chat = gr.Chatbot(type="messages", height=450)
+               memoria_chat = gr.State(None)  # Memória resumida, uma por sessão
+               with gr.Row():
+                   mensagem_chat = gr.Textbox(placeholder="Ex.: Quero um personagem furtivo, qual raça e classe combinam?", show_label=False, scale=9)
+                   enviar_btn = gr.Button("Enviar", variant="primary", scale=1)
+               limpar_chat_btn = gr.Button("🧹 Nova conversa", variant="secondary")
+
+
+           with gr.TabItem("Biblioteca"):
+               with gr.Row():
+                   filtro_nome = gr.Textbox(label="Nome")
+                   filtro_raca = gr.Dropdown(choices=[r.value for r in Raca], label="Raça")
+                   filtro_classe = gr.Dropdown(choices=[c.value for c in Classe], label="Classe")
+                   filtro_antecedente = gr.Dropdown(choices=ANTECEDENTES, label="Antecedente")
+                   filtro_alinhamento = gr.Dropdown(choices=ALINHAMENTOS, label="Alinhamento")
+              
+               with gr.Row():
+                   pagina = gr.Number(value=1, minimum=1, precision=0, label="Página", scale=1)
+                   buscar_btn = gr.Button("🔍 Buscar", variant="primary", scale=2)
+              
+               resumo_busca = gr.Markdown("")
+               tabela_personagens = gr.Dataframe(headers=COLUNAS_BIBLIOTECA, interactive=False)
+              
+               with gr.Row():
+                   personagem_id = gr.Number(precision=0, label="ID do Personagem", scale=3)
+                   carregar_btn = gr.Button("📂 Carregar", scale=1)
+               personagem_json = gr.Code(language="json")
+              
+               with gr.Accordion("Exportar", open=False):
+                   with gr.Row():
+                       formato_exportacao = gr.Radio(["JSONL", "CSV"], value="JSONL", label="Formato")
+                       exportar_btn = gr.Button("💾 Exportar")
+                   arquivo_exportacao = gr.File(label="Arquivo exportado")
+
+
        def mostrar_personagem(*args):
            resultado = criar_personagem(*args)
            if isinstance(resultado[0], str) and resultado[0].startswith("⚠️"):
@@ -277,10 +445,10 @@ def interface():
            )
       
        # Eventos de informação
-       raca_info.click(get_info, inputs=[raca], outputs=[info_output])
-       classe_info.click(get_info, inputs=[classe], outputs=[info_output])
-       antecedente_info.click(get_info, inputs=[antecedente], outputs=[info_output])
-       alinhamento_info.click(get_info, inputs=[alinhamento], outputs=[info_output])
+       raca_info.click(get_info, inputs=[raca, fontes], outputs=[info_output])
+       classe_info.click(get_info, inputs=[classe, fontes], outputs=[info_output])
+       antecedente_info.click(get_info, inputs=[antecedente, fontes], outputs=[info_output])
+       alinhamento_info.click(get_info, inputs=[alinhamento, fontes], outputs=[info_output])
       
        # Eventos principais
        criar_btn.click(
@@ -293,6 +461,38 @@ def interface():
            outputs=tabs
        )
       
+       # Eventos da conversa
+       # A entrada fica bloqueada durante o turno, então cada sessão tem no máximo um turno
+       # em andamento; o paralelismo fica só entre sessões diferentes
+       for evento in [enviar_btn.click, mensagem_chat.submit]:
+           evento(
+               bloquear_entrada,
+               outputs=[mensagem_chat, enviar_btn],
+               queue=False,
+               trigger_mode="once"
+           ).then(
+               conversar,
+               inputs=[mensagem_chat, chat, memoria_chat],
+               outputs=[mensagem_chat, enviar_btn, chat, memoria_chat],
+               concurrency_limit=CHAT_CONCURRENCY_LIMIT,
+               concurrency_id="conversa"
+           )
+       limpar_chat_btn.click(lambda: ([], None), outputs=[chat, memoria_chat])
+      
+       # Eventos da biblioteca
+       filtros_biblioteca = [filtro_nome, filtro_raca, filtro_classe, filtro_antecedente, filtro_alinhamento]
+       buscar_btn.click(
+           buscar_personagens,
+           inputs=filtros_biblioteca + [pagina],
+           outputs=[tabela_personagens, resumo_busca]
+       )
+       carregar_btn.click(carregar_personagem, inputs=[personagem_id], outputs=[personagem_json])
+       exportar_btn.click(
+           exportar_personagens,
+           inputs=[formato_exportacao] + filtros_biblioteca,
+           outputs=[arquivo_exportacao]
+       )
+      
        def limpar():
            return [gr.update(value=None) for _ in range(12)]
       
@@ -3,82 +3,231 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.chains import RetrievalQA
-from config import CAPITULOS, KNOWLEDGE_BASE_PATH, PDF_PATH, KEYWORD_MAPPING
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from config import FONTES, INDICES_PATH, KEYWORD_MAPPING
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timezone
+import hashlib
+import json
 import os
 import tiktoken
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+MANIFEST_FILE = "manifest.json"
+
+
+class ParticoesRetriever(BaseRetriever):
+    """Busca em cada partição selecionada e une os top-k pelo score"""
+
+    knowledge_base: Any
+    fontes: List[str]
+    filtro: Dict[str, Any] = {}
+    k: int = 5
+
+    def _buscar_particao(self, particao: FAISS, embedding: List[float]) -> list:
+        if not self.filtro:
+            return particao.similarity_search_with_score_by_vector(embedding, k=self.k)
+
+        # O filtro é aplicado depois da busca: começa com poucos candidatos e só amplia
+        # se o capítulo não tiver aparecido o suficiente entre eles
+        fetch_k = max(4 * self.k, 20)
+        while True:
+            resultados = particao.similarity_search_with_score_by_vector(
+                embedding, k=self.k, filter=self.filtro, fetch_k=fetch_k
+            )
+            if len(resultados) >= self.k or fetch_k >= particao.index.ntotal:
+                return resultados
+            fetch_k *= 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        capitulo_id = self.filtro.get("chapter_id")
+        if capitulo_id and not any(
+            capitulo_id in self.knowledge_base.capitulos_por_fonte[fonte_id] for fonte_id in self.fontes
+        ):
+            # Nenhuma fonte escolhida tem o capítulo deduzido da pergunta: busca sem esse filtro
+            return self.model_copy(update={"filtro": {}})._get_relevant_documents(query, run_manager=run_manager)
+
+        embedding = self.knowledge_base.embeddings.embed_query(query)
+        resultados = []
+        for fonte_id in self.fontes:
+            # Partições sem o capítulo não têm o que devolver com esse filtro
+            if capitulo_id and capitulo_id not in self.knowledge_base.capitulos_por_fonte[fonte_id]:
+                continue
+            resultados.extend(self._buscar_particao(self.knowledge_base.particoes[fonte_id], embedding))
+        # Scores são distâncias L2: quanto menor, mais relevante
+        resultados.sort(key=lambda resultado: resultado[1])
+        return [documento for documento, _ in resultados[:self.k]]
+
+
 class DnDKnowledgeBase:
-    def __init__(self, llm):
+    def __init__(self, llm, fontes: Dict[str, Dict[str, any]] = FONTES):
         self.llm = llm
-        self.vector_store = self._load_or_create_vectorstore()
-    
-    def _load_or_create_vectorstore(self):
-        if os.path.exists(KNOWLEDGE_BASE_PATH):
-            print("Carregando base de conhecimento existente...")
-            embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-            return FAISS.load_local(KNOWLEDGE_BASE_PATH, embeddings, allow_dangerous_deserialization=True)
-        
-        return self._create_vectorstore()
-    
-    def _create_vectorstore(self):
-        print("Criando nova base de conhecimento...")
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+        self.fontes = fontes
+        self.embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        self.particoes = self._load_or_create_partitions()
+        self.capitulos_por_fonte = {
+            fonte_id: {documento.metadata.get("chapter_id") for documento in particao.docstore._dict.values()}
+            for fonte_id, particao in self.particoes.items()
+        }
+
+    def _load_or_create_partitions(self) -> Dict[str, FAISS]:
+        # Cada fonte é uma partição independente, consultada separadamente em query()
+        return {
+            fonte_id: self._load_or_create_partition(fonte_id, info)
+            for fonte_id, info in self.fontes.items()
+        }
+
+    def _index_path(self, fonte_id: str, info: dict) -> str:
+        return info.get("index_path") or os.path.join(INDICES_PATH, f"{fonte_id}.faiss")
+
+    def _config_hash(self, info: dict) -> str:
+        return hashlib.sha256(json.dumps({
+            "capitulos": info["capitulos"],
+            "embedding": EMBEDDING_MODEL,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP
+        }, sort_keys=True).encode()).hexdigest()
+
+    def _pdf_state(self, info: dict, manifest: Optional[dict] = None) -> Optional[dict]:
+        """Identifica o PDF da fonte; o hash só é recalculado se tamanho ou mtime mudaram"""
+        caminho = info["pdf_path"]
+        if not os.path.exists(caminho):
+            return None
+
+        stat = os.stat(caminho)
+        estado = {"tamanho": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        anterior = (manifest or {}).get("pdf") or {}
+        if anterior.get("tamanho") == estado["tamanho"] and anterior.get("mtime_ns") == estado["mtime_ns"]:
+            estado["sha256"] = anterior["sha256"]
+            return estado
+
+        hash_pdf = hashlib.sha256()
+        with open(caminho, "rb") as pdf:
+            for bloco in iter(lambda: pdf.read(1 << 20), b""):
+                hash_pdf.update(bloco)
+        estado["sha256"] = hash_pdf.hexdigest()
+        return estado
+
+    def _read_manifest(self, index_path: str) -> Optional[dict]:
+        caminho = os.path.join(index_path, MANIFEST_FILE)
+        if not os.path.exists(caminho):
+            return None
+        with open(caminho, encoding="utf-8") as arquivo:
+            return json.load(arquivo)
+
+    def _write_manifest(self, index_path: str, manifest: dict):
+        with open(os.path.join(index_path, MANIFEST_FILE), "w", encoding="utf-8") as arquivo:
+            json.dump(manifest, arquivo, indent=2)
+
+    def _load_or_create_partition(self, fonte_id: str, info: dict) -> FAISS:
+        index_path = self._index_path(fonte_id, info)
+        if not os.path.exists(index_path):
+            return self._create_partition(fonte_id, info)
+
+        manifest = self._read_manifest(index_path)
+
+        # Índices sem manifesto (criados antes do registro de fontes) têm versão desconhecida:
+        # são usados como estão e nunca recebem um manifesto que não foi verificado
+        if manifest is not None and "pdf" in manifest:
+            pdf = self._pdf_state(info, manifest)
+            # Sem o PDF não há como reconstruir, então a partição existente é usada como está
+            if pdf is not None:
+                if pdf["sha256"] != manifest["pdf"]["sha256"] or manifest.get("config") != self._config_hash(info):
+                    print(f"Fonte alterada, reconstruindo partição: {info['name']}...")
+                    return self._create_partition(fonte_id, info, pdf)
+                if pdf != manifest["pdf"]:
+                    # Mesmo conteúdo com mtime novo: só os dados do PDF são atualizados, para não
+                    # recalcular o hash no próximo início; a data de criação do índice continua a mesma
+                    self._write_manifest(index_path, {**manifest, "pdf": pdf})
+
+        print(f"Carregando partição existente: {info['name']}...")
+        particao = FAISS.load_local(index_path, self.embeddings, allow_dangerous_deserialization=True)
+
+        # Índices criados antes do registro de fontes não têm o id da fonte nos documentos
+        for documento in particao.docstore._dict.values():
+            documento.metadata.setdefault("source_id", fonte_id)
+
+        return particao
+
+    def _create_partition(self, fonte_id: str, info: dict, pdf: Optional[dict] = None) -> FAISS:
+        print(f"Criando partição da base de conhecimento: {info['name']}...")
         todos_documentos = []
         # largeembeddings / smalltextembeddings
-        loader = PyPDFLoader(PDF_PATH)
+        loader = PyPDFLoader(info["pdf_path"])
         paginas = loader.load()
-        
-        for capitulo_id, info in CAPITULOS.items():
-            print(f"Processando capítulo: {info['name']}...")
-            
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=len,
+            separators=["\n\n\n", "\n\n", "\n", ". ", " ", ""]
+        )
+
+        for capitulo_id, capitulo in info["capitulos"].items():
+            print(f"Processando capítulo: {capitulo['name']}...")
+
             paginas_capitulo = [
-                p for p in paginas 
-                if info['start'] <= int(p.metadata.get('page', 0)) <= info['end']
+                p for p in paginas
+                if capitulo['start'] <= int(p.metadata.get('page', 0)) <= capitulo['end']
             ]
-            
+
             for pagina in paginas_capitulo:
-                pagina.metadata['chapter'] = info['name']
+                pagina.metadata['chapter'] = capitulo['name']
                 pagina.metadata['chapter_id'] = capitulo_id
-            
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=2000,
-                chunk_overlap=200,
-                length_function=len,
-                separators=["\n\n\n", "\n\n", "\n", ". ", " ", ""]
-            )
+                pagina.metadata['source_id'] = fonte_id
+                pagina.metadata['source_name'] = info['name']
+
             chunks = text_splitter.split_documents(paginas_capitulo)
             todos_documentos.extend(chunks)
-        
-        vectorstore = FAISS.from_documents(todos_documentos, embeddings)
-        vectorstore.save_local(KNOWLEDGE_BASE_PATH)
-        return vectorstore
-    
-    def get_chapter_for_query(self, query: str) -> str:
+
+        index_path = self._index_path(fonte_id, info)
+        particao = FAISS.from_documents(todos_documentos, self.embeddings)
+        particao.save_local(index_path)
+        self._write_manifest(index_path, {
+            "fonte": fonte_id,
+            "pdf": pdf or self._pdf_state(info),
+            "config": self._config_hash(info),
+            "documentos": len(todos_documentos),
+            "criado_em": datetime.now(timezone.utc).isoformat()
+        })
+        return particao
+
+    def _get_chapter_id_for_query(self, query: str) -> Optional[str]:
         query_lower = query.lower()
         for chapter, keywords in KEYWORD_MAPPING.items():
             if any(keyword in query_lower for keyword in keywords):
-                return CAPITULOS[chapter]['name']
+                return chapter
         return None
-    
-    def query(self, query: str) -> dict:
-        capitulo = self.get_chapter_for_query(query)
-        search_kwargs = {"k": 5}
-        
-        if capitulo:
-            search_kwargs["filter"] = {"chapter": capitulo}
-        
+
+    def query(self, query: str, fontes: Optional[List[str]] = None) -> dict:
+        # O filtro usa o id do capítulo, que é compartilhado entre as fontes
+        capitulo_id = self._get_chapter_id_for_query(query)
+
+        filtro = {}
+        if capitulo_id:
+            filtro["chapter_id"] = capitulo_id
+
+        # Só as partições das fontes escolhidas são consultadas; sem escolha, todas
+        fontes_busca = [f for f in fontes if f in self.particoes] if fontes else list(self.particoes)
+
         qa_chain = RetrievalQA.from_chain_type(
             llm=self.llm,
             chain_type="stuff",
-            retriever=self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs=search_kwargs
+            retriever=ParticoesRetriever(
+                knowledge_base=self,
+                fontes=fontes_busca,
+                filtro=filtro,
+                k=5
             ),
             return_source_documents=True
         )
-        
+
         resultado = qa_chain.invoke({"query": query})
-        
+
         # Conta tokens
         encoding = tiktoken.encoding_for_model("gpt-4o-mini")
         tokens_entrada = len(encoding.encode(query))
@@ -94,4 +243,4 @@ class DnDKnowledgeBase:
                 "saida": tokens_saida,
                 "total": tokens_entrada + tokens_documentos + tokens_saida
             }
-        } 
\ No newline at end of file
+        }
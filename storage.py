@@ -0,0 +1,308 @@
+from config import CHARACTERS_DB_PATH, STORAGE_BATCH_SIZE, STORAGE_FLUSH_INTERVAL
+from models import PersonagemDnD
+from typing import Any, Dict, Iterator, List, Optional
+from datetime import datetime, timezone
+import csv
+import orjson
+import queue
+import sqlite3
+import threading
+import time
+
+# Colunas indexadas usadas como filtro nas buscas
+CAMPOS_FILTRO = ("raca", "classe", "antecedente", "alinhamento")
+
+CAMPOS_ATRIBUTOS = ("forca", "destreza", "constituicao", "inteligencia", "sabedoria", "carisma")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS personagens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL,
+    raca TEXT,
+    classe TEXT,
+    antecedente TEXT,
+    alinhamento TEXT,
+    criado_em TEXT NOT NULL,
+    dados BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_personagens_raca ON personagens (raca, id);
+CREATE INDEX IF NOT EXISTS idx_personagens_classe ON personagens (classe, id);
+CREATE INDEX IF NOT EXISTS idx_personagens_antecedente ON personagens (antecedente, id);
+CREATE INDEX IF NOT EXISTS idx_personagens_alinhamento ON personagens (alinhamento, id);
+"""
+
+INSERT_PERSONAGEM = (
+    "INSERT INTO personagens "
+    "(nome, raca, classe, antecedente, alinhamento, criado_em, dados) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+_FIM = object()
+
+
+class PersonagemStore:
+    """Armazena personagens em SQLite, com escrita em lote feita por uma thread dedicada."""
+
+    def __init__(self, caminho: str = CHARACTERS_DB_PATH,
+                 tamanho_lote: int = STORAGE_BATCH_SIZE,
+                 intervalo_flush: float = STORAGE_FLUSH_INTERVAL):
+        self.caminho = caminho
+        self.tamanho_lote = tamanho_lote
+        self.intervalo_flush = intervalo_flush
+        self._local = threading.local()
+        self._fila: queue.Queue = queue.Queue()
+        # Linhas que não puderam ser gravadas nem individualmente, para inspeção ou nova tentativa
+        self.falhas: List[tuple] = []
+        self._fechado = False
+        self._erro_writer: Optional[BaseException] = None
+        self._lock_fila = threading.Lock()
+
+        conexao = self._conectar()
+        conexao.executescript(SCHEMA)
+        conexao.commit()
+        conexao.close()
+
+        self._writer = threading.Thread(target=self._loop_escrita, name="personagem-writer", daemon=True)
+        self._writer.start()
+
+    def _conectar(self) -> sqlite3.Connection:
+        conexao = sqlite3.connect(self.caminho)
+        # WAL permite leituras enquanto a thread de escrita grava um lote
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute("PRAGMA synchronous=NORMAL")
+        return conexao
+
+    def _conexao_leitura(self) -> sqlite3.Connection:
+        # sqlite3 não compartilha conexões entre threads, então cada thread tem a sua
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None:
+            conexao = self._conectar()
+            conexao.row_factory = sqlite3.Row
+            self._local.conexao = conexao
+        return conexao
+
+    # Escrita
+
+    def _verificar_writer(self):
+        if self._fechado:
+            raise RuntimeError("O armazenamento de personagens já foi fechado.")
+        if not self._writer.is_alive():
+            raise RuntimeError(
+                f"A thread de escrita de personagens parou; {self._fila.unfinished_tasks} "
+                f"personagens pendentes não foram gravados."
+            ) from self._erro_writer
+
+    def salvar(self, personagem: PersonagemDnD) -> None:
+        """Enfileira o personagem para gravação; a escrita acontece em segundo plano."""
+        dados = personagem.model_dump(mode="json")
+        linha = (
+            dados["nome"],
+            dados["raca"],
+            dados["classe"],
+            dados["antecedente"],
+            dados["alinhamento"],
+            datetime.now(timezone.utc).isoformat(),
+            orjson.dumps(dados),
+        )
+        with self._lock_fila:
+            self._verificar_writer()
+            self._fila.put(linha)
+
+    def flush(self) -> None:
+        """Bloqueia até que todos os personagens enfileirados tenham sido gravados."""
+        # Equivale a Queue.join(), mas não espera para sempre se a thread de escrita morrer
+        with self._fila.all_tasks_done:
+            while self._fila.unfinished_tasks:
+                if not self._writer.is_alive():
+                    self._verificar_writer()
+                self._fila.all_tasks_done.wait(timeout=self.intervalo_flush)
+
+    def fechar(self) -> None:
+        """Grava o que ainda estiver na fila e encerra a thread de escrita."""
+        with self._lock_fila:
+            if self._fechado:
+                return
+            self._fechado = True
+            if not self._writer.is_alive():
+                pendentes = self._fila.unfinished_tasks
+                if pendentes:
+                    print(f"Thread de escrita parada: {pendentes} personagens pendentes não foram gravados.")
+                return
+            self._fila.put(_FIM)
+        self._writer.join()
+
+    def _loop_escrita(self):
+        try:
+            conexao = self._conectar()
+        except Exception as e:
+            print(f"Erro ao abrir o banco de personagens para escrita: {str(e)}")
+            self._erro_writer = e
+            return
+
+        encerrar = False
+        while not encerrar:
+            item = self._fila.get()
+            lote = []
+            recebidos = 1
+            if item is _FIM:
+                encerrar = True
+            else:
+                lote.append(item)
+
+            # Agrupa o que chegar até o prazo do lote para gravar numa única transação
+            prazo = time.monotonic() + self.intervalo_flush
+            while not encerrar and len(lote) < self.tamanho_lote:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    item = self._fila.get(timeout=restante)
+                except queue.Empty:
+                    break
+                recebidos += 1
+                if item is _FIM:
+                    encerrar = True
+                else:
+                    lote.append(item)
+
+            try:
+                if lote:
+                    self._gravar_lote(conexao, lote)
+            except Exception as e:
+                # Qualquer erro fica restrito ao lote; a thread continua atendendo a fila
+                print(f"Erro inesperado ao gravar lote de {len(lote)} personagens: {str(e)}")
+                self.falhas.extend(lote)
+            finally:
+                for _ in range(recebidos):
+                    self._fila.task_done()
+        conexao.close()
+
+    def _gravar_lote(self, conexao: sqlite3.Connection, lote: list):
+        try:
+            with conexao:
+                conexao.executemany(INSERT_PERSONAGEM, lote)
+            return
+        except sqlite3.Error as e:
+            print(f"Erro ao gravar lote de {len(lote)} personagens, gravando um a um: {str(e)}")
+
+        # Um registro problemático não deve levar o lote inteiro junto
+        for linha in lote:
+            try:
+                with conexao:
+                    conexao.execute(INSERT_PERSONAGEM, linha)
+            except sqlite3.Error as e:
+                print(f"Erro ao gravar personagem '{linha[0]}' ({linha[5]}): {str(e)}")
+                self.falhas.append(linha)
+
+    # Leitura
+
+    def _montar_filtro(self, filtros: Dict[str, Optional[str]]) -> tuple[str, list]:
+        condicoes = []
+        parametros = []
+        for campo in CAMPOS_FILTRO:
+            valor = filtros.get(campo)
+            if valor:
+                condicoes.append(f"{campo} = ?")
+                parametros.append(valor)
+        nome = filtros.get("nome")
+        if nome:
+            # Escapa os curingas do LIKE para que o nome seja buscado literalmente
+            nome = nome.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            condicoes.append("nome LIKE ? ESCAPE '\\'")
+            parametros.append(f"%{nome}%")
+        where = f" WHERE {' AND '.join(condicoes)}" if condicoes else ""
+        return where, parametros
+
+    def contar(self, **filtros) -> int:
+        where, parametros = self._montar_filtro(filtros)
+        linha = self._conexao_leitura().execute(
+            f"SELECT COUNT(*) FROM personagens{where}", parametros
+        ).fetchone()
+        return linha[0]
+
+    def buscar(self, pagina: int = 1, por_pagina: int = 20, antes_de_id: Optional[int] = None,
+               **filtros) -> List[Dict[str, Any]]:
+        """Retorna um resumo dos personagens que casam com os filtros, do mais recente ao mais antigo.
+
+        Com `antes_de_id` (o menor id da página anterior) a paginação usa os índices (campo, id)
+        e custa o mesmo em qualquer página; só com `pagina` o SQLite percorre todas as linhas
+        puladas pelo OFFSET, o que fica mais lento quanto mais funda a página.
+        """
+        where, parametros = self._montar_filtro(filtros)
+        if antes_de_id is not None:
+            where = f"{where} AND id < ?" if where else " WHERE id < ?"
+            parametros.append(antes_de_id)
+            offset = 0
+        else:
+            offset = (max(int(pagina), 1) - 1) * por_pagina
+        linhas = self._conexao_leitura().execute(
+            "SELECT id, nome, raca, classe, antecedente, alinhamento, criado_em "
+            f"FROM personagens{where} ORDER BY id DESC LIMIT ? OFFSET ?",
+            parametros + [por_pagina, offset]
+        ).fetchall()
+        return [dict(linha) for linha in linhas]
+
+    def carregar(self, personagem_id: int) -> Optional[PersonagemDnD]:
+        linha = self._conexao_leitura().execute(
+            "SELECT dados FROM personagens WHERE id = ?", (personagem_id,)
+        ).fetchone()
+        if linha is None:
+            return None
+        return PersonagemDnD.model_validate(orjson.loads(linha["dados"]))
+
+    def _iterar_dados(self, filtros: Dict[str, Optional[str]], tamanho_bloco: int = 500) -> Iterator[tuple[int, str, bytes]]:
+        where, parametros = self._montar_filtro(filtros)
+        # Conexão própria para não prender o cursor da thread durante a exportação
+        conexao = self._conectar()
+        try:
+            cursor = conexao.execute(
+                f"SELECT id, criado_em, dados FROM personagens{where} ORDER BY id", parametros
+            )
+            while True:
+                bloco = cursor.fetchmany(tamanho_bloco)
+                if not bloco:
+                    break
+                yield from bloco
+        finally:
+            conexao.close()
+
+    # Exportação
+
+    def exportar_jsonl(self, caminho: str, **filtros) -> int:
+        """Exporta os personagens em JSON Lines sem carregar a coleção inteira em memória."""
+        total = 0
+        with open(caminho, "wb") as arquivo:
+            for personagem_id, criado_em, dados in self._iterar_dados(filtros):
+                # Os dados já estão em JSON compacto: id e criado_em entram no início do objeto,
+                # sem desserializar o resto
+                arquivo.write(b'{"id":%d,"criado_em":%s,' % (personagem_id, orjson.dumps(criado_em)))
+                arquivo.write(dados[1:])
+                arquivo.write(b"\n")
+                total += 1
+        return total
+
+    def exportar_csv(self, caminho: str, **filtros) -> int:
+        """Exporta os personagens em CSV, com uma coluna por atributo."""
+        colunas = ["id", "criado_em", "nome", "sexo", *CAMPOS_FILTRO, *CAMPOS_ATRIBUTOS,
+                   "pericias", "equipamento", "caracteristicas", "historia"]
+        total = 0
+        with open(caminho, "w", newline="", encoding="utf-8") as arquivo:
+            writer = csv.writer(arquivo)
+            writer.writerow(colunas)
+            for personagem_id, criado_em, dados in self._iterar_dados(filtros):
+                personagem = orjson.loads(dados)
+                atributos = personagem.get("atributos", {})
+                writer.writerow([
+                    personagem_id,
+                    criado_em,
+                    personagem.get("nome"),
+                    personagem.get("sexo"),
+                    *(personagem.get(campo) for campo in CAMPOS_FILTRO),
+                    *(atributos.get(campo) for campo in CAMPOS_ATRIBUTOS),
+                    "; ".join(personagem.get("pericias", [])),
+                    "; ".join(personagem.get("equipamento", [])),
+                    orjson.dumps(personagem.get("caracteristicas", {})).decode(),
+                    personagem.get("historia", ""),
+                ])
+                total += 1
+        return total